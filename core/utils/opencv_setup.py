@@ -0,0 +1,32 @@
+import cv2
+
+
+# cv::CPU_AVX2 is not exported by the Python bindings; resolve its id by name
+CPU_AVX2 = next(i for i in range(1, 512) if cv2.getHardwareFeatureName(i) == "AVX2")
+
+
+def get_simd_build_info():
+    """
+    SIMD levels OpenCV was built with (not what the CPU supports), from cv2.getBuildInformation():
+        {"Baseline": "SSE SSE2 SSE3", "Dispatched code generation": "SSE4_1 ... AVX2 ..."}
+    """
+    features = {}
+    for line in cv2.getBuildInformation().splitlines():
+        key, sep, value = line.strip().partition(":")
+        if sep and key in ("Baseline", "Dispatched code generation"):
+            features[key] = value.strip()
+    return features
+
+
+def configure_opencv(num_threads=1):
+    """Enable OpenCV's optimized (SIMD) code paths, set its process-wide thread count and log AVX2 availability"""
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(num_threads)
+
+    features = get_simd_build_info()
+    compiled = " ".join(features.values()).split()
+    avx2 = "AVX2" in compiled and cv2.checkHardwareSupport(CPU_AVX2)
+    print(f"OpenCV {cv2.__version__}: threads={cv2.getNumThreads()}, optimized={cv2.useOptimized()}, AVX2={avx2}")
+    for k, v in features.items():
+        print(f"  {k}: {v}")
+    return avx2
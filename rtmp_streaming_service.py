@@ -1,44 +1,150 @@
 import asyncio
+import collections
+import functools
+import os
 import threading
-import time
 import numpy as np
 import cv2
 import subprocess
-import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import pyaudio
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import uvicorn
 
-from stream_pipeline_online import StreamSDK
+from stream_pipeline_online import SDKPool
+from core.utils.opencv_setup import configure_opencv
+
+
+# Low-latency ffmpeg options per H.264 encoder
+H264_ENCODER_ARGS = {
+    'h264_nvenc': ['-preset', 'p1', '-tune', 'll', '-rc', 'cbr', '-zerolatency', '1'],
+    'libx264': ['-preset', 'ultrafast', '-tune', 'zerolatency'],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_can_encode(vcodec: str) -> bool:
+    """
+    Check (once per codec) that ffmpeg can actually open the encoder with the
+    options start() will pass, not just list it
+    """
+    probe_cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=size=256x256:rate=1',
+        '-frames:v', '1', '-c:v', vcodec, '-pix_fmt', 'yuv420p',
+        *H264_ENCODER_ARGS.get(vcodec, []),
+        '-f', 'null', '-',
+    ]
+    try:
+        result = subprocess.run(probe_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+def select_h264_encoder() -> str:
+    """Prefer the NVENC hardware encoder, fall back to libx264"""
+    if ffmpeg_can_encode('h264_nvenc'):
+        return 'h264_nvenc'
+    return 'libx264'
+
+
+def rgb_to_i420_torch(frame, height, width, fmt="rgb"):
+    """
+    Convert an HxWx3 (uint8 or 0-255 float) torch tensor to a (H*3/2)xW uint8
+    YUV420p (I420) tensor on the tensor's device, resizing to height x width.
+    Uses the BT.601 limited-range coefficients of cv2.COLOR_RGB2YUV_I420.
+    """
+    import torch
+    import torch.nn.functional as F
+
+    x = frame.permute(2, 0, 1).unsqueeze(0).float()    # [1, 3, h, w]
+    if fmt != "rgb":
+        x = x.flip(1)
+    if x.shape[2] != height or x.shape[3] != width:
+        mode = "area" if x.shape[2] > height and x.shape[3] > width else "bilinear"
+        x = F.interpolate(x, size=(height, width), mode=mode, align_corners=False if mode == "bilinear" else None)
+    r, g, b = x[0, 0], x[0, 1], x[0, 2]
+
+    y = 0.257 * r + 0.504 * g + 0.098 * b + 16
+    # chroma is linear in RGB, so average each 2x2 block first
+    x_half = F.avg_pool2d(x, 2)[0]
+    r, g, b = x_half[0], x_half[1], x_half[2]
+    u = -0.148 * r - 0.291 * g + 0.439 * b + 128
+    v = 0.439 * r - 0.368 * g - 0.071 * b + 128
+
+    yuv = torch.cat([y.reshape(-1), u.reshape(-1), v.reshape(-1)])
+    return yuv.round_().clamp_(0, 255).to(torch.uint8).reshape(height * 3 // 2, width)
 
 
 class RTMPStreamWriter:
     """RTMP video writer using ffmpeg pipe"""
     
-    def __init__(self, rtmp_url: str, width: int = 512, height: int = 512, fps: int = 25):
+    MAX_WRITEV_FRAMES = 4    # frames coalesced into one writev() call
+    RING_SLOTS = 13          # frame buffers queued, in writev() or being filled; newer frames are dropped when all are in use (live stream)
+    
+    def __init__(self, rtmp_url: str, width: int = 512, height: int = 512, fps: int = 25, vcodec: str = None):
         self.rtmp_url = rtmp_url
         self.width = width
         self.height = height
         self.fps = fps
+        self.vcodec = vcodec    # None: auto-select (NVENC if usable, else libx264)
         self.process = None
         self.is_active = False
         
+        self._fd = None
+        self._frames = collections.deque()    # ring slot indices queued for ffmpeg
+        self._frames_cv = threading.Condition()
+        self._pipe_thread = None
+        
+        # Writer-owned YUV420p (I420) frame buffers fed to ffmpeg. A slot is taken
+        # from the free list by the producer and only given back by the pipe thread
+        # once its writev() is done, so a queued or in-flight buffer is never
+        # overwritten; when no slot is free the incoming frame is dropped
+        assert self.width % 2 == 0 and self.height % 2 == 0, "yuv420p needs even frame size"
+        self._ring = [
+            np.empty((self.height * 3 // 2, self.width), dtype=np.uint8)
+            for _ in range(self.RING_SLOTS)
+        ]
+        self._free_slots = collections.deque(range(len(self._ring)))
+        self._resize_buf = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        
+        # write_cuda state: pinned ring, copy stream, per-slot copy-done events
+        self._pinned_ring = None
+        self._cuda_stream = None
+        self._cuda_events = None
+        self._cuda_pending = None    # ring slot whose D2H copy is still in flight
+        
+    def _acquire_slot(self):
+        """Index of a free YUV420p frame buffer in the ring, or None if all are in use"""
+        with self._frames_cv:
+            return self._free_slots.popleft() if self._free_slots else None
+        
+    def _enqueue(self, idx):
+        """Hand a filled ring slot to the pipe thread (no per-frame write/flush here)"""
+        with self._frames_cv:
+            self._frames.append(idx)
+            self._frames_cv.notify()
+        
     def start(self):
         """Start the RTMP stream"""
+        if self.vcodec is None:
+            self.vcodec = select_h264_encoder()
+        
         ffmpeg_cmd = [
             'ffmpeg',
             '-y',  # Overwrite output
             '-f', 'rawvideo',
             '-vcodec', 'rawvideo',
-            '-pix_fmt', 'rgb24',
+            '-pix_fmt', 'yuv420p',  # converted on our side, half the bytes of rgb24
             '-s', f'{self.width}x{self.height}',
             '-r', str(self.fps),
             '-i', '-',  # Input from pipe
-            '-c:v', 'libx264',
+            '-c:v', self.vcodec,
             '-pix_fmt', 'yuv420p',
-            '-preset', 'ultrafast',
-            '-tune', 'zerolatency',
+            *H264_ENCODER_ARGS.get(self.vcodec, []),
             '-g', '30',
             '-sc_threshold', '0',
             '-f', 'flv',
@@ -50,8 +156,13 @@ class RTMPStreamWriter:
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
+        self._fd = self.process.stdin.fileno()
         self.is_active = True
-        print(f"Started RTMP stream to {self.rtmp_url}")
+        
+        # Dedicated thread drains queued frames into the ffmpeg pipe
+        self._pipe_thread = threading.Thread(target=self._pipe_worker, daemon=True)
+        self._pipe_thread.start()
+        print(f"Started RTMP stream to {self.rtmp_url} ({self.vcodec})")
         
     def __call__(self, frame_rgb, fmt="rgb"):
         """Write frame to RTMP stream"""
@@ -59,24 +170,138 @@ class RTMPStreamWriter:
             return
             
         try:
-            # Ensure frame is RGB and correct size
-            if fmt != "rgb":
-                frame_rgb = cv2.cvtColor(frame_rgb, cv2.COLOR_BGR2RGB)
+            # Ensure frame is uint8 and correct size
+            if frame_rgb.dtype != np.uint8:
+                frame_rgb = frame_rgb.astype(np.uint8)
+            
+            h, w = frame_rgb.shape[0], frame_rgb.shape[1]
+            if h != self.height or w != self.width:
+                # Area filter avoids aliasing on downscale, bilinear is cheaper on upscale
+                interpolation = cv2.INTER_AREA if h > self.height and w > self.width else cv2.INTER_LINEAR
+                frame_rgb = cv2.resize(
+                    frame_rgb, (self.width, self.height), dst=self._resize_buf, interpolation=interpolation
+                )
+            
+            # Keep frame order if a write_cuda frame is still in flight
+            if self._cuda_pending is not None:
+                self._flush_cuda_pending()
             
-            if frame_rgb.shape[:2] != (self.height, self.width):
-                frame_rgb = cv2.resize(frame_rgb, (self.width, self.height))
+            # ffmpeg is behind and every buffer is queued or being written
+            idx = self._acquire_slot()
+            if idx is None:
+                return
             
-            # Write to ffmpeg pipe
-            self.process.stdin.write(frame_rgb.tobytes())
-            self.process.stdin.flush()
+            # Convert straight to YUV420p (SIMD path in OpenCV) into a ring buffer;
+            # BGR input uses the BGR variant, so no separate channel swap
+            code = cv2.COLOR_RGB2YUV_I420 if fmt == "rgb" else cv2.COLOR_BGR2YUV_I420
+            cv2.cvtColor(frame_rgb, code, dst=self._ring[idx])
+            self._enqueue(idx)
             
         except (BrokenPipeError, OSError):
             print("RTMP stream disconnected")
             self.is_active = False
     
+    def write_cuda(self, frame_tensor, fmt="rgb"):
+        """
+        Write an HxWx3 frame held as a CUDA torch tensor: YUV420p conversion
+        runs on the device, so only the 1.5 bytes/pixel result is copied to host.
+        
+        The D2H copy is issued asynchronously on a dedicated stream into a pinned
+        ring buffer; the frame is handed to ffmpeg on the next call, so the copy
+        overlaps with producing the next frame (double buffering).
+        """
+        if not self.is_active or self.process is None:
+            return
+        
+        import torch
+        
+        if self._pinned_ring is None:
+            # Back the ring with page-locked memory so copies can run async;
+            # queued frames keep their content, in-flight writes keep the old array
+            self._pinned_ring = [
+                torch.empty(buf.shape, dtype=torch.uint8, pin_memory=True) for buf in self._ring
+            ]
+            with self._frames_cv:
+                for t, buf in zip(self._pinned_ring, self._ring):
+                    t.numpy()[...] = buf
+                self._ring = [t.numpy() for t in self._pinned_ring]
+            self._cuda_stream = torch.cuda.Stream(device=frame_tensor.device)
+            self._cuda_events = [torch.cuda.Event() for _ in self._ring]
+        
+        # Previous frame's copy has had a whole frame time to complete
+        if self._cuda_pending is not None:
+            self._flush_cuda_pending()
+        
+        # ffmpeg is behind and every buffer is queued or being written
+        idx = self._acquire_slot()
+        if idx is None:
+            return
+        
+        frame_yuv = rgb_to_i420_torch(frame_tensor, self.height, self.width, fmt=fmt)
+        self._cuda_stream.wait_stream(torch.cuda.current_stream(frame_yuv.device))
+        with torch.cuda.stream(self._cuda_stream):
+            self._pinned_ring[idx].copy_(frame_yuv, non_blocking=True)
+            self._cuda_events[idx].record(self._cuda_stream)
+        frame_yuv.record_stream(self._cuda_stream)
+        self._cuda_pending = idx
+    
+    def _flush_cuda_pending(self):
+        """Wait for the in-flight D2H copy and hand its buffer to the pipe thread"""
+        idx = self._cuda_pending
+        self._cuda_pending = None
+        self._cuda_events[idx].synchronize()
+        self._enqueue(idx)
+    
+    def _pipe_worker(self):
+        """Write queued frames to ffmpeg, batching several per writev()"""
+        while True:
+            with self._frames_cv:
+                while self.is_active and not self._frames:
+                    self._frames_cv.wait()
+                if not self._frames:
+                    break
+                n = min(len(self._frames), self.MAX_WRITEV_FRAMES)
+                slots = [self._frames.popleft() for _ in range(n)]
+                bufs = [self._ring[idx] for idx in slots]
+            
+            try:
+                self._writev_all(bufs)
+            except (BrokenPipeError, OSError):
+                print("RTMP stream disconnected")
+                self.is_active = False
+                break
+            
+            # Buffers are only reusable once ffmpeg has taken them
+            with self._frames_cv:
+                self._free_slots.extend(slots)
+    
+    def _writev_all(self, bufs):
+        """writev() may write partially; keep going until every buffer is sent"""
+        bufs = [memoryview(b).cast("B") for b in bufs]
+        while bufs:
+            written = os.writev(self._fd, bufs)
+            while bufs and written >= len(bufs[0]):
+                written -= len(bufs[0])
+                bufs.pop(0)
+            if bufs and written:
+                bufs[0] = bufs[0][written:]
+    
     def close(self):
         """Stop the RTMP stream"""
-        self.is_active = False
+        if self._cuda_pending is not None and self.is_active:
+            self._flush_cuda_pending()
+        with self._frames_cv:
+            self.is_active = False
+            self._frames_cv.notify()
+        if self._pipe_thread is not None:
+            # Remaining queued frames are flushed before the thread exits
+            self._pipe_thread.join(timeout=5)
+            if self._pipe_thread.is_alive() and self.process:
+                # ffmpeg stopped reading: killing it fails the pending writev() with EPIPE
+                self.process.kill()
+                self._pipe_thread.join()
+            self._pipe_thread = None
+        # stdin (and its fd number) is only released once no thread writes to it
         if self.process:
             try:
                 self.process.stdin.close()
@@ -89,14 +314,23 @@ class RTMPStreamWriter:
 class AudioCapture:
     """Real-time audio capture using PyAudio"""
     
-    def __init__(self, sample_rate=16000, chunk_size=1024):
+    def __init__(self, sample_rate=16000, chunk_size=1024, ring_size=100):
         self.sample_rate = sample_rate
         self.chunk_size = chunk_size
         self.audio = pyaudio.PyAudio()
         self.stream = None
-        self.audio_queue = queue.Queue(maxsize=100)
         self.is_active = False
         
+        # Single-producer/single-consumer ring, allocated once: the callback only
+        # advances _w, the consumer only advances _r (oldest chunks are dropped
+        # by the consumer once the writer laps it)
+        self.ring_size = ring_size
+        self._ring = np.empty((ring_size, chunk_size), dtype=np.float32)
+        self._w = 0
+        self._r = 0
+        
+        self.on_chunk = None    # optional callable, invoked by the callback after each queued chunk
+        
     def start_capture(self):
         """Start capturing audio from microphone"""
         try:
@@ -117,24 +351,40 @@ class AudioCapture:
     def _audio_callback(self, in_data, frame_count, time_info, status):
         """Audio callback function"""
         if self.is_active:
-            audio_data = np.frombuffer(in_data, dtype=np.float32)
-            try:
-                self.audio_queue.put_nowait(audio_data)
-            except queue.Full:
-                # Drop oldest audio if queue is full
-                try:
-                    self.audio_queue.get_nowait()
-                    self.audio_queue.put_nowait(audio_data)
-                except queue.Empty:
-                    pass
+            np.copyto(self._ring[self._w % self.ring_size], np.frombuffer(in_data, dtype=np.float32))
+            self._w += 1
+            if self.on_chunk is not None:
+                self.on_chunk()
         return (None, pyaudio.paContinue)
     
-    def get_audio_chunk(self, timeout=1.0):
-        """Get next audio chunk"""
-        try:
-            return self.audio_queue.get(timeout=timeout)
-        except queue.Empty:
-            return None
+    def _pop_chunk(self):
+        """Copy the oldest unread chunk out of the ring, or None if empty"""
+        while True:
+            w = self._w
+            if w - self._r >= self.ring_size:
+                # Writer lapped us: slot w % ring_size (== oldest unread) may be
+                # being written right now, so keep only the ring_size - 1 newest
+                self._r = w - self.ring_size + 1
+            if self._r >= w:
+                return None
+            chunk = self._ring[self._r % self.ring_size].copy()
+            self._r += 1
+            if self._w - self._r < self.ring_size - 1:
+                return chunk
+            # Slot may have been overwritten while copying, skip it
+    
+    def has_pending_audio(self):
+        """Whether unread chunks are in the ring"""
+        return self._r < self._w
+    
+    def drain_audio_chunks(self):
+        """Get all queued audio chunks without blocking"""
+        chunks = []
+        while True:
+            chunk = self._pop_chunk()
+            if chunk is None:
+                return chunks
+            chunks.append(chunk)
     
     def stop_capture(self):
         """Stop audio capture"""
@@ -149,15 +399,27 @@ class AudioCapture:
 class TalkingHeadRTMPService:
     """RTMP Streaming service for talking head generation"""
     
-    def __init__(self, cfg_pkl: str, data_root: str):
+    def __init__(self, cfg_pkl: str, data_root: str, max_workers: int = None, sdk_pool_size: int = 1):
         self.cfg_pkl = cfg_pkl
         self.data_root = data_root
         self.active_streams = {}
         
+        # Shared audio workers: threads are spawned on demand, so the pool holds
+        # min(active streams, max_workers) threads; at most one job per stream
+        self._audio_executor = ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count() or 1,
+            thread_name_prefix="audio_worker",
+        )
+        self._audio_inflight = set()
+        self._audio_inflight_lock = threading.Lock()
+        
+        # Warm SDKs, handed out per stream and returned on stop
+        self._sdk_pool = SDKPool(self.cfg_pkl, self.data_root, sdk_pool_size)
+        
     def create_stream(self, stream_id: str, source_path: str, rtmp_url: str):
         """Create a new RTMP stream"""
-        # Initialize SDK
-        sdk = StreamSDK(self.cfg_pkl, self.data_root)
+        # Get a warm SDK
+        sdk = self._sdk_pool.acquire()
         
         # RTMP writer
         rtmp_writer = RTMPStreamWriter(rtmp_url)
@@ -174,10 +436,18 @@ class TalkingHeadRTMPService:
             "max_size": 512,
         }
         
-        sdk.setup(source_path, "/dev/null", **setup_kwargs)
+        try:
+            sdk.setup(source_path, "/dev/null", **setup_kwargs)
+        except Exception:
+            # The stream is never registered, so stop_stream would not clean up
+            self._sdk_pool.release(sdk)
+            rtmp_writer.close()
+            audio_capture.stop_capture()
+            raise
         sdk.writer = rtmp_writer  # Replace writer
         
         self.active_streams[stream_id] = {
+            "stream_id": stream_id,
             "sdk": sdk,
             "rtmp_writer": rtmp_writer,
             "audio_capture": audio_capture,
@@ -192,20 +462,41 @@ class TalkingHeadRTMPService:
             return
             
         stream = self.active_streams[stream_id]
-        stream["audio_capture"].start_capture()
         
-        # Start audio processing thread
-        def audio_processor():
+        # Audio chunks are processed on the shared worker pool as they arrive
+        stream["audio_capture"].on_chunk = lambda: self._schedule_audio(stream_id)
+        stream["audio_capture"].start_capture()
+    
+    def _schedule_audio(self, stream_id: str):
+        """Submit an audio job for a stream unless one is already in flight"""
+        stream = self.active_streams.get(stream_id)
+        if stream is None or not stream["active"]:
+            return
+        with self._audio_inflight_lock:
+            if stream_id in self._audio_inflight:
+                return
+            self._audio_inflight.add(stream_id)
+        stream["audio_future"] = self._audio_executor.submit(self._process_audio, stream)
+    
+    def _process_audio(self, stream):
+        """Drain and process all pending audio chunks of a stream"""
+        audio_capture = stream["audio_capture"]
+        try:
             while stream["active"]:
-                audio_chunk = stream["audio_capture"].get_audio_chunk()
-                if audio_chunk is not None:
-                    # Process audio chunk
-                    stream["sdk"].run_chunk(audio_chunk)
-                else:
-                    time.sleep(0.01)  # Small delay if no audio
-        
-        stream["audio_thread"] = threading.Thread(target=audio_processor)
-        stream["audio_thread"].start()
+                chunks = audio_capture.drain_audio_chunks()
+                if not chunks:
+                    break
+                # One call per drained batch; the SDK cuts it into model windows
+                stream["sdk"].run_stream(np.concatenate(chunks))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self._audio_inflight_lock:
+                self._audio_inflight.discard(stream["stream_id"])
+        
+        # Chunks that arrived after the last drain while this job was in flight
+        if stream["active"] and audio_capture.has_pending_audio():
+            self._schedule_audio(stream["stream_id"])
     
     def stop_stream(self, stream_id: str):
         """Stop a stream"""
@@ -216,12 +507,20 @@ class TalkingHeadRTMPService:
             # Stop audio capture
             stream["audio_capture"].stop_capture()
             
-            # Wait for audio thread
-            if "audio_thread" in stream:
-                stream["audio_thread"].join(timeout=5)
+            # Wait for the in-flight audio job, then feed the leftover ring
+            # chunks and the SDK's buffered tail to the model
+            try:
+                if "audio_future" in stream:
+                    stream["audio_future"].result(timeout=5)
+                chunks = stream["audio_capture"].drain_audio_chunks()
+                tail = np.concatenate(chunks) if chunks else np.zeros((0,), dtype=np.float32)
+                stream["sdk"].run_stream(tail, final=True)
+            except Exception:
+                traceback.print_exc()
             
-            # Stop SDK and RTMP
+            # Stop SDK and RTMP; the SDK is reused by the next stream
             stream["sdk"].close()
+            self._sdk_pool.release(stream["sdk"])
             stream["rtmp_writer"].close()
             
             del self.active_streams[stream_id]
@@ -233,9 +532,10 @@ app = FastAPI(title="Ditto TalkingHead RTMP Streaming Service")
 # Global service
 service = None
 
-def init_service(cfg_pkl: str, data_root: str):
+def init_service(cfg_pkl: str, data_root: str, sdk_pool_size: int = 1, cv2_num_threads: int = 1):
     global service
-    service = TalkingHeadRTMPService(cfg_pkl, data_root)
+    configure_opencv(num_threads=cv2_num_threads)
+    service = TalkingHeadRTMPService(cfg_pkl, data_root, sdk_pool_size=sdk_pool_size)
 
 
 class StreamRequest(BaseModel):
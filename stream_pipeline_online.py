@@ -231,6 +231,9 @@ class StreamSDK:
             self.audio_feat = np.zeros((0, self.wav2feat.feat_dim), dtype=np.float32)
         self.cond_idx_start = 0 - len(self.audio_feat)
 
+        # ======== Stream Audio Buffer (run_stream) ========
+        self.stream_audio = None
+
         # ======== Setup Worker Threads ========
         QUEUE_MAX_SIZE = 100
         # self.QUEUE_TIMEOUT = None
@@ -497,6 +500,34 @@ class StreamSDK:
         if self.worker_exception is not None:
             raise self.worker_exception
         
+    def run_stream(self, audio, chunksize=(3, 5, 2), final=False):
+        # only for hubert
+        # audio: 16k mono float32 of any length; run_chunk is called once per
+        # complete window (split_len samples, hop chunksize[1] * 640)
+        # final: also zero-pad and run the windows still holding buffered audio,
+        # as inference.py does for the last chunks; call once before close()
+        split_len = int(sum(chunksize) * 0.04 * 16000) + 80    # 6480
+        hop = chunksize[1] * 640
+        if self.stream_audio is None:
+            # left context of chunksize[0] * 640 zeros, as in inference.py
+            self.stream_audio = np.zeros((chunksize[0] * 640,), dtype=np.float32)
+        self.stream_audio = np.concatenate([self.stream_audio, np.asarray(audio, dtype=np.float32)], 0)
+
+        s = 0
+        while len(self.stream_audio) - s >= split_len:
+            self.run_chunk(self.stream_audio[s: s + split_len], chunksize)
+            s += hop
+        if final:
+            # a window's new audio starts after its chunksize[0] * 640 context samples
+            while len(self.stream_audio) - s > chunksize[0] * 640:
+                audio_chunk = self.stream_audio[s: s + split_len]
+                audio_chunk = np.pad(audio_chunk, (0, split_len - len(audio_chunk)), mode="constant")
+                self.run_chunk(audio_chunk, chunksize)
+                s += hop
+            self.stream_audio = None
+        elif s > 0:
+            self.stream_audio = self.stream_audio[s:]
+
     def run_chunk(self, audio_chunk, chunksize=(3, 5, 2)):
         # only for hubert
         aud_feat = self.wav2feat(audio_chunk, chunksize=chunksize)
@@ -508,4 +539,26 @@ class StreamSDK:
                 continue
 
 
+class SDKPool:
+    """Warm StreamSDKs (models already loaded), handed out per stream and returned on stop"""
+
+    def __init__(self, cfg_pkl, data_root, size=1):
+        self.cfg_pkl = cfg_pkl
+        self.data_root = data_root
+        self._pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(StreamSDK(cfg_pkl, data_root))
 
+    def acquire(self):
+        """Take a warm SDK, or load a new one if the pool is empty; setup() still runs per stream"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return StreamSDK(self.cfg_pkl, self.data_root)
+
+    def release(self, sdk):
+        """Return a closed SDK to the pool (dropped if the pool is full)"""
+        try:
+            self._pool.put_nowait(sdk)
+        except queue.Full:
+            pass
@@ -1,16 +1,29 @@
 import asyncio
-import base64
+import collections
+import inspect
 import io
 import json
+import struct
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 import uvicorn
 
-from stream_pipeline_online import StreamSDK
+from stream_pipeline_online import SDKPool
+from core.utils.opencv_setup import configure_opencv
+
+
+# Binary frame message: [u8 type][u64 little-endian timestamp in ms][JPEG bytes]
+MSG_TYPE_FRAME = 1
+FRAME_HEADER = struct.Struct("<BQ")
+
+# Audio bytes merged before dispatching to the SDK: one model window hop
+# (chunksize[1] * 640 samples of float32)
+AUDIO_BATCH_BYTES = 5 * 640 * 4
 
 
 class StreamingVideoWriter:
@@ -18,64 +31,136 @@ class StreamingVideoWriter:
     
     def __init__(self, websocket: WebSocket):
         self.websocket = websocket
-        self.frame_queue = asyncio.Queue(maxsize=30)  # Buffer up to 30 frames
         self.is_active = True
         
-    def __call__(self, frame_rgb, fmt="rgb"):
-        """Called by the pipeline to write frames"""
-        if not self.is_active:
-            return
-            
-        # Convert RGB to BGR for OpenCV
+        # Frames are produced on the pipeline's writer thread and consumed on the
+        # event loop: a bounded deque (drops oldest) plus a loop-side event
+        self._frame_buffer = collections.deque(maxlen=30)  # Buffer up to 30 frames
+        self._frame_lock = threading.Lock()
+        self._frame_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        
+        # SIMD libjpeg-turbo encoder if PyTurboJPEG is installed, else cv2.imencode
+        self._tj = None
+        try:
+            import turbojpeg
+            self._tj = turbojpeg.TurboJPEG()
+            self._tj_pixel_format = {"rgb": turbojpeg.TJPF_RGB, "bgr": turbojpeg.TJPF_BGR}
+            self._tj_subsample = turbojpeg.TJSAMP_422
+        except (ImportError, OSError, RuntimeError):
+            pass
+        
+        # Newer PyTurboJPEG can compress into a caller-provided buffer: messages
+        # are then built in place in pooled bytearrays, recycled after sending
+        self._tj_dst = self._tj is not None and "dst" in inspect.signature(self._tj.encode).parameters
+        self._msg_pool = collections.deque()
+        
+    def _encode_jpeg(self, frame_rgb, fmt="rgb"):
+        """Encode a frame as JPEG bytes"""
+        if self._tj is not None:
+            # turbojpeg takes RGB directly, no channel swap needed
+            return self._tj.encode(
+                np.ascontiguousarray(frame_rgb), quality=80, pixel_format=self._tj_pixel_format[fmt]
+            )
+        
+        # Convert RGB to BGR for OpenCV; cv2 copies the negative-stride view internally,
+        # so this fallback still pays one full-frame copy (the turbojpeg path avoids it)
         if fmt == "rgb":
-            frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
+            frame_bgr = frame_rgb[..., ::-1]
         else:
             frame_bgr = frame_rgb
-            
-        # Encode frame as JPEG
         _, buffer = cv2.imencode('.jpg', frame_bgr, [cv2.IMWRITE_JPEG_QUALITY, 80])
-        frame_base64 = base64.b64encode(buffer).decode('utf-8')
+        return buffer
+    
+    def _encode_message_in_place(self, frame_rgb, fmt, timestamp_ms):
+        """Encode header + JPEG into a pooled buffer; returns a memoryview of the message"""
+        # PyTurboJPEG checks dst against tj3JPEGBufSize(w, h, subsamp); for the
+        # 4:2:2 subsampling passed below that is PAD(w, 16) * PAD(h, 8) * 4 + 2048
+        h, w = frame_rgb.shape[:2]
+        buf_size = FRAME_HEADER.size + ((w + 15) // 16 * 16) * ((h + 7) // 8 * 8) * 4 + 2048
+        buf = self._msg_pool.pop() if self._msg_pool else None
+        if buf is None or len(buf) < buf_size:
+            buf = bytearray(buf_size)
         
-        # Add to queue (non-blocking)
-        try:
-            self.frame_queue.put_nowait({
-                "type": "frame",
-                "data": frame_base64,
-                "timestamp": time.time()
-            })
-        except asyncio.QueueFull:
-            # Drop oldest frame if queue is full
+        result = self._tj.encode(
+            np.ascontiguousarray(frame_rgb), quality=80, pixel_format=self._tj_pixel_format[fmt],
+            jpeg_subsample=self._tj_subsample, dst=memoryview(buf)[FRAME_HEADER.size:],
+        )
+        if not isinstance(result, tuple):
+            raise TypeError(f"unexpected encode(dst=...) result: {type(result).__name__}")
+        _, jpeg_size = result
+        FRAME_HEADER.pack_into(buf, 0, MSG_TYPE_FRAME, timestamp_ms)
+        return memoryview(buf)[:FRAME_HEADER.size + jpeg_size]
+    
+    def _encode_message(self, frame_rgb, fmt, timestamp_ms):
+        """Encode a frame into a binary frame message"""
+        if self._tj_dst:
             try:
-                self.frame_queue.get_nowait()
-                self.frame_queue.put_nowait({
-                    "type": "frame", 
-                    "data": frame_base64,
-                    "timestamp": time.time()
-                })
-            except asyncio.QueueEmpty:
-                pass
+                return self._encode_message_in_place(frame_rgb, fmt, timestamp_ms)
+            except TypeError as e:
+                # dst= not supported as expected by this PyTurboJPEG version
+                print(f"In-place JPEG encoding unavailable, falling back: {e}")
+                self._tj_dst = False
+        jpeg = self._encode_jpeg(frame_rgb, fmt)
+        return b"".join((FRAME_HEADER.pack(MSG_TYPE_FRAME, timestamp_ms), jpeg))
+    
+    def release_message(self, msg):
+        """Return a sent message's buffer to the pool"""
+        if isinstance(msg, memoryview):
+            self._msg_pool.append(msg.obj)
+            msg.release()
+        
+    def __call__(self, frame_rgb, fmt="rgb"):
+        """Called by the pipeline to write frames"""
+        if not self.is_active:
+            return
+            
+        # Encode frame as a JPEG message (runs on the pipeline's writer thread, not the event loop)
+        msg = self._encode_message(frame_rgb, fmt, int(time.time() * 1000))
+        
+        # Add to buffer (non-blocking, deque drops the oldest frame when full);
+        # the loop only needs a wakeup when the buffer goes from empty to non-empty
+        with self._frame_lock:
+            was_empty = not self._frame_buffer
+            if len(self._frame_buffer) == self._frame_buffer.maxlen:
+                self.release_message(self._frame_buffer[0])
+            self._frame_buffer.append(msg)
+        if was_empty:
+            self._loop.call_soon_threadsafe(self._frame_event.set)
+    
+    async def get_frames(self):
+        """Wait for frames and drain all pending ones; returns None once closed and empty"""
+        if self.is_active:
+            await self._frame_event.wait()
+            self._frame_event.clear()
+        with self._frame_lock:
+            frames = list(self._frame_buffer)
+            self._frame_buffer.clear()
+        if not frames and not self.is_active:
+            return None
+        return frames
     
     def close(self):
         """Stop the writer"""
         self.is_active = False
-        try:
-            self.frame_queue.put_nowait({"type": "end"})
-        except asyncio.QueueFull:
-            pass
+        self._loop.call_soon_threadsafe(self._frame_event.set)  # wake up get_frames
 
 
 class TalkingHeadStreamingService:
     """Real-time talking head streaming service"""
     
-    def __init__(self, cfg_pkl: str, data_root: str):
+    def __init__(self, cfg_pkl: str, data_root: str, sdk_pool_size: int = 1):
         self.cfg_pkl = cfg_pkl
         self.data_root = data_root
         self.active_sessions = {}
         
+        # Warm SDKs, handed out per session and returned on stop
+        self._sdk_pool = SDKPool(self.cfg_pkl, self.data_root, sdk_pool_size)
+        
     def create_session(self, session_id: str, source_path: str, websocket: WebSocket):
         """Create a new streaming session"""
-        # Initialize SDK
-        sdk = StreamSDK(self.cfg_pkl, self.data_root)
+        # Get a warm SDK
+        sdk = self._sdk_pool.acquire()
         
         # Custom streaming writer
         streaming_writer = StreamingVideoWriter(websocket)
@@ -89,13 +174,21 @@ class TalkingHeadStreamingService:
         }
         
         # Monkey patch the writer to use our streaming writer
-        sdk.setup(source_path, "/dev/null", **setup_kwargs)  # dummy output path
+        try:
+            sdk.setup(source_path, "/dev/null", **setup_kwargs)  # dummy output path
+        except Exception:
+            # The session is never registered, so close_session would not clean up
+            self._sdk_pool.release(sdk)
+            raise
         sdk.writer = streaming_writer
         
         self.active_sessions[session_id] = {
             "sdk": sdk,
             "writer": streaming_writer,
             "websocket": websocket,
+            # The SDK is not thread-safe: one worker per session keeps
+            # run_chunk calls ordered and off the event loop
+            "executor": ThreadPoolExecutor(max_workers=1),
             "active": True
         }
         
@@ -106,14 +199,30 @@ class TalkingHeadStreamingService:
         if session_id in self.active_sessions:
             session = self.active_sessions[session_id]
             if session["active"]:
-                session["sdk"].run_chunk(audio_data)
+                session["sdk"].run_stream(audio_data)
+    
+    def process_audio_messages(self, session_id: str, messages: list):
+        """Merge raw audio messages (16 kHz mono float32 PCM), then process them as one chunk"""
+        audio_array = np.concatenate([np.frombuffer(m, dtype=np.float32) for m in messages])
+        self.process_audio_chunk(session_id, audio_array)
+    
+    async def submit_audio_messages(self, session_id: str, messages: list):
+        """Run process_audio_messages on the session's SDK executor"""
+        if session_id in self.active_sessions:
+            executor = self.active_sessions[session_id]["executor"]
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, self.process_audio_messages, session_id, messages)
     
     def close_session(self, session_id: str):
         """Close a streaming session"""
         if session_id in self.active_sessions:
             session = self.active_sessions[session_id]
             session["active"] = False
+            # Feed the buffered tail (less than one model window) before closing
+            session["executor"].submit(session["sdk"].run_stream, np.zeros((0,), dtype=np.float32), final=True)
+            session["executor"].shutdown(wait=True)
             session["sdk"].close()
+            self._sdk_pool.release(session["sdk"])
             session["writer"].close()
             del self.active_sessions[session_id]
 
@@ -124,9 +233,10 @@ app = FastAPI(title="Ditto TalkingHead Streaming Service")
 # Global service instance
 service = None
 
-def init_service(cfg_pkl: str, data_root: str):
+def init_service(cfg_pkl: str, data_root: str, sdk_pool_size: int = 1, cv2_num_threads: int = 1):
     global service
-    service = TalkingHeadStreamingService(cfg_pkl, data_root)
+    configure_opencv(num_threads=cv2_num_threads)
+    service = TalkingHeadStreamingService(cfg_pkl, data_root, sdk_pool_size=sdk_pool_size)
 
 
 @app.get("/")
@@ -155,9 +265,42 @@ async def get_demo_page():
         
         <script>
             let ws = null;
-            let mediaRecorder = null;
+            let audioContext = null;
+            let micStream = null;
             let isStreaming = false;
             
+            // AudioWorklet that posts raw Float32 PCM chunks (what the server
+            // feeds to the model); the AudioContext runs at 16 kHz, so the
+            // browser resamples the mic with proper anti-alias filtering
+            const PCM_WORKLET = `
+                class PCMCaptureProcessor extends AudioWorkletProcessor {
+                    constructor(options) {
+                        super();
+                        this.chunkSize = options.processorOptions.chunkSize;
+                        this.buffer = new Float32Array(this.chunkSize);
+                        this.filled = 0;
+                    }
+                    process(inputs) {
+                        const input = inputs[0][0];
+                        if (!input) return true;
+                        let i = 0;
+                        while (i < input.length) {
+                            const n = Math.min(input.length - i, this.chunkSize - this.filled);
+                            this.buffer.set(input.subarray(i, i + n), this.filled);
+                            this.filled += n;
+                            i += n;
+                            if (this.filled === this.chunkSize) {
+                                this.port.postMessage(this.buffer, [this.buffer.buffer]);
+                                this.buffer = new Float32Array(this.chunkSize);
+                                this.filled = 0;
+                            }
+                        }
+                        return true;
+                    }
+                }
+                registerProcessor('pcm-capture', PCMCaptureProcessor);
+            `;
+            
             const video = document.getElementById('output');
             const canvas = document.createElement('canvas');
             const ctx = canvas.getContext('2d');
@@ -185,7 +328,7 @@ async def get_demo_page():
                     updateStatus('Requesting microphone access...');
                     
                     // Get microphone access
-                    const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+                    micStream = await navigator.mediaDevices.getUserMedia({ audio: true });
                     
                     // Setup WebSocket - dynamically use current host
                     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -196,6 +339,7 @@ async def get_demo_page():
                     updateStatus('Connecting to server...');
                     
                     ws = new WebSocket(wsUrl);
+                    ws.binaryType = 'arraybuffer';
                     
                     ws.onopen = () => {
                         console.log('WebSocket connected');
@@ -223,27 +367,31 @@ async def get_demo_page():
                     };
                     
                     ws.onmessage = (event) => {
-                        const data = JSON.parse(event.data);
-                        if (data.type === 'frame') {
-                            displayFrame(data.data);
+                        if (!(event.data instanceof ArrayBuffer)) return;
+                        // [u8 type][u64 LE timestamp ms][JPEG bytes]
+                        const header = new DataView(event.data, 0, 9);
+                        if (header.getUint8(0) === 1) {
+                            displayFrame(new Blob([event.data.slice(9)], { type: 'image/jpeg' }));
                         }
                     };
                 
-                // Setup audio recording
-                mediaRecorder = new MediaRecorder(stream, {
-                    mimeType: 'audio/webm;codecs=pcm'
-                });
+                // Setup audio capture: 16 kHz mono Float32 PCM
+                audioContext = new AudioContext({ sampleRate: 16000 });
+                const workletUrl = URL.createObjectURL(new Blob([PCM_WORKLET], { type: 'application/javascript' }));
+                await audioContext.audioWorklet.addModule(workletUrl);
+                URL.revokeObjectURL(workletUrl);
                 
-                mediaRecorder.ondataavailable = (event) => {
-                    if (event.data.size > 0 && ws.readyState === WebSocket.OPEN) {
+                const pcmNode = new AudioWorkletNode(audioContext, 'pcm-capture', {
+                    numberOfOutputs: 0,
+                    processorOptions: { chunkSize: 1600 }  // 100ms chunks at 16 kHz
+                });
+                pcmNode.port.onmessage = (event) => {
+                    if (ws.readyState === WebSocket.OPEN) {
                         // Send audio data to server
-                        event.data.arrayBuffer().then(buffer => {
-                            ws.send(buffer);
-                        });
+                        ws.send(event.data.buffer);
                     }
                 };
-                
-                mediaRecorder.start(200); // 200ms chunks
+                audioContext.createMediaStreamSource(micStream).connect(pcmNode);
                 isStreaming = true;
                 
                 } catch (error) {
@@ -255,9 +403,11 @@ async def get_demo_page():
                 }
             }
             
-            function displayFrame(base64Data) {
+            function displayFrame(jpegBlob) {
                 const img = new Image();
+                const imgUrl = URL.createObjectURL(jpegBlob);
                 img.onload = () => {
+                    URL.revokeObjectURL(imgUrl);
                     canvas.width = img.width;
                     canvas.height = img.height;
                     ctx.drawImage(img, 0, 0);
@@ -268,7 +418,7 @@ async def get_demo_page():
                         video.src = url;
                     }, 'image/jpeg');
                 };
-                img.src = 'data:image/jpeg;base64,' + base64Data;
+                img.src = imgUrl;
             }
             
             function stopStreaming() {
@@ -276,8 +426,13 @@ async def get_demo_page():
                 
                 updateStatus('Stopping...');
                 
-                if (mediaRecorder) {
-                    mediaRecorder.stop();
+                if (audioContext) {
+                    audioContext.close();
+                    audioContext = null;
+                }
+                if (micStream) {
+                    micStream.getTracks().forEach(track => track.stop());
+                    micStream = null;
                 }
                 if (ws) {
                     ws.close();
@@ -312,20 +467,27 @@ async def websocket_endpoint(websocket: WebSocket):
             frame_task = asyncio.create_task(stream_frames(session_id, websocket))
             
             # Process incoming audio
+            pending_audio = []
+            pending_bytes = 0
             while True:
                 try:
                     # Receive audio data
                     audio_data = await websocket.receive_bytes()
+                    pending_audio.append(audio_data)
+                    pending_bytes += len(audio_data)
                     
-                    # Convert WebRTC audio to numpy array (simplified)
-                    # In production, you'd need proper audio decoding
-                    audio_array = np.frombuffer(audio_data, dtype=np.float32)
-                    
-                    # Process audio chunk
-                    service.process_audio_chunk(session_id, audio_array)
+                    # Process a batch of messages on the SDK executor
+                    if pending_bytes >= AUDIO_BATCH_BYTES:
+                        await service.submit_audio_messages(session_id, pending_audio)
+                        pending_audio = []
+                        pending_bytes = 0
                     
                 except WebSocketDisconnect:
                     break
+            
+            # Flush the remaining partial batch
+            if pending_audio:
+                await service.submit_audio_messages(session_id, pending_audio)
                     
     except Exception as e:
         print(f"WebSocket error: {e}")
@@ -344,14 +506,19 @@ async def stream_frames(session_id: str, websocket: WebSocket):
     
     try:
         while session["active"]:
-            # Get frame from queue
-            frame_data = await writer.frame_queue.get()
+            # Get all pending frames
+            frames = await writer.get_frames()
             
-            if frame_data["type"] == "end":
+            if frames is None:
                 break
                 
-            # Send frame to client
-            await websocket.send_text(json.dumps(frame_data))
+            # Send frames to client as binary messages
+            for msg in frames:
+                # msg may be a memoryview over a pooled buffer that is reused right
+                # after this; uvicorn's websocket protocols copy the frame into the
+                # transport before send_bytes returns, so this relies on uvicorn
+                await websocket.send_bytes(msg)
+                writer.release_message(msg)
             
     except Exception as e:
         print(f"Frame streaming error: {e}")